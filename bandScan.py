@@ -16,21 +16,30 @@ The neurofeedback protocols described here are inspired by
 Adapted from https://github.com/NeuroTechX/bci-workshop
 """
 
+import time
+from queue import Queue, Empty, Full
+from threading import Thread, Event
 import numpy as np  # Module that simplifies computations on matrices
 import matplotlib.pyplot as plt  # Module used for plotting
+from matplotlib.collections import LineCollection
 from matplotlib.font_manager import FontProperties
+from matplotlib.lines import Line2D
 from pylsl import StreamInlet, resolve_byprop  # Module to receive EEG data
 import utils  # Our own utility functions
+import _bandpowers_numba
 
-# Handy little enum to make code more readable
+# Handy little constants to make code more readable
+# Band powers are plain vectors in this order, so bands can be indexed together
+DELTA, THETA, ALPHA, BETA, GAMMA = range(5)
 
+# Legend label and plot colour of each band, in band order
+BAND_NAMES = ('Delta', 'Theta', 'Alpha', 'Beta', 'Gamma')
+BAND_COLORS = ('red', 'orange', 'yellow', 'green', 'blue')
 
-class Band:
-    Delta = 0
-    Theta = 1
-    Alpha = 2
-    Beta = 3
-    Gamma = 4
+# Neurofeedback ratios computed in one division:
+# alpha/delta, beta/theta and theta/alpha
+RATIO_NUMERATORS = np.array([ALPHA, BETA, THETA])
+RATIO_DENOMINATORS = np.array([DELTA, THETA, ALPHA])
 
 
 """ EXPERIMENTAL PARAMETERS """
@@ -48,6 +57,11 @@ class Parameters:
     # Index of the channel(s) (electrodes) to be used
     # 0 = left ear, 1 = left forehead, 2 = right forehead, 3 = right ear
     INDEX_CHANNEL = [0]
+    # Maximum number of new epochs computed at once; when more shifts than
+    # this are waiting, only the newest ones are computed
+    BATCH = 4
+    # Length of the band power history shown in the plot (in seconds)
+    PLOT_LENGTH = 120
 
 class GetWaves:
     def __init__(self, timeout=2):       
@@ -56,6 +70,9 @@ class GetWaves:
         bufferLength = Parameters.BUFFER_LENGTH
         self.epochLength = Parameters.EPOCH_LENGTH
         self.shiftLength = Parameters.SHIFT_LENGTH
+        self.batch = Parameters.BATCH
+        # The buffers hold a single channel
+        self.channel = Parameters.INDEX_CHANNEL[0]
         
         # Search for active LSL streams
         print('Looking for an EEG stream...')
@@ -65,7 +82,11 @@ class GetWaves:
 
         # Set active EEG stream to inlet and apply time correction
         print("Start acquiring data")
-        self.inlet = StreamInlet(streams[0], max_chunklen=12)
+        # Chunks of one shift, so samples are handed over as soon as an
+        # epoch can be computed
+        self.inlet = StreamInlet(
+            streams[0], recover=True,
+            max_chunklen=int(self.shiftLength * streams[0].nominal_srate()))
         eeg_time_correction = self.inlet.time_correction()
     
         # Get the stream info and description
@@ -77,134 +98,300 @@ class GetWaves:
         # collected in a second. This influences our frequency band calculation.
         # for the Muse 2016, this should always be 256
         self.fs = int(info.nominal_srate())
+        self.epochSamples = int(self.epochLength * self.fs)
+        self.shiftSamples = int(self.shiftLength * self.fs)
     
         """ 2. INITIALIZE BUFFERS """
     
         # Initialize raw EEG data buffer
-        self.eeg_buffer = np.zeros((int(self.fs * bufferLength), 1))
+        # EEG needs no more than float32, which halves the memory traffic
+        self.eeg_buffer = utils.RingBuffer(int(self.fs * bufferLength), 1,
+                                           dtype=np.float32)
         self.filter_state = None  # for use with the notch filter
+        # Samples pushed since the end of the newest computed epoch
+        self.pending = 0
     
-        # Compute the number of epochs in "buffer_length"
-        n_win_test = int(np.floor((bufferLength - self.epochLength) /
-                                  self.shiftLength + 1))
-    
-        # Initialize the band power buffer (for plotting)
-        # bands will be ordered: [delta, theta, alpha, beta]
-        self.band_buffer = np.zeros((n_win_test, 5))
+        # Exponential moving average of the band powers, used for smoothing
+        # bands will be ordered: [delta, theta, alpha, beta, gamma]
+        # Its time constant roughly matches the length of the buffer
+        self.ema = np.zeros(5, dtype=np.float32)
+        self.emaAlpha = self.shiftLength / bufferLength
+        # Scratch row for the update, so no temporaries are made per epoch
+        self._row = np.empty(5, dtype=np.float32)
+
+        # PSD bins of each band, fixed by the epoch length and fs
+        self._bins = utils.get_band_bins(utils.nextpow2(self.epochSamples),
+                                         self.fs)
+        # Constant inputs of the compiled band power kernel
+        if _bandpowers_numba.HAVE_NUMBA:
+            self._basis = _bandpowers_numba.make_basis(self.epochSamples,
+                                                       self.fs, self._bins)
 
+        """ 2.1 INITIALIZE PLOT """
+        # All five bands are one persistent LineCollection; run() only updates
+        # its segments and blits it over a cached background instead of
+        # redrawing the figure.
+        # Title, legend and font are laid out here, and again only when the
+        # axes have to be rescaled.
+        # The plot sweeps over a fixed window like a monitor: the newest
+        # epoch overwrites the oldest one in a preallocated history, so the
+        # time axis never moves and memory stays bounded
+        self.historyLength = int(Parameters.PLOT_LENGTH / self.shiftLength)
+        plt.ion()
+        self.fig, self.ax = plt.subplots(figsize=(8,6))
+        font = FontProperties(family='ubuntu',
+                              weight='bold',
+                              style='oblique', size=6.5)
+        # Segments [band, epoch, (time, power)]; only the power changes.
+        # Epoch x is stored in slot x % historyLength of the powers
+        self.segments = np.empty((5, self.historyLength, 2), dtype=np.float32)
+        self.segments[:, :, 0] = (np.arange(self.historyLength)
+                                  * self.shiftLength)
+        self.powers = self.segments[:, :, 1]
+        self.powers[:] = np.nan  # not yet received, left blank
+        self.drawn = 0  # index of the epoch after the newest one drawn
+        self.waves = LineCollection(self.segments, colors=BAND_COLORS,
+                                    animated=True)
+        self.ax.add_collection(self.waves, autolim=False)
+        self.ax.set_xlim(0, self.historyLength * self.shiftLength)
+        self.ax.set_title('Brain Waves')
+        self.ax.legend([Line2D([], [], color=color) for color in BAND_COLORS],
+                       BAND_NAMES, prop=font)
+        self.fig.canvas.mpl_connect('draw_event', self.captureBackground)
+        self.fig.show()
+        self.fig.canvas.draw()
+
+        # Console output is throttled to once per logInterval seconds
+        self.logInterval = 1.0
+        self.lastLog = -self.logInterval
+
+        # Hand-over from the acquisition thread to the drawing loop
+        self.queue = Queue(maxsize=16)
+        self.stopped = Event()
+        self.error = None  # exception that ended the acquisition thread
+
+    def captureBackground(self, event=None):
+        """Cache everything but the band lines for blitting."""
+        self.bg = self.fig.canvas.copy_from_bbox(self.ax.bbox)
+
+    def draw(self, batches):
+        """Write (x, band_powers [n_epochs, 5]) batches and blit the bands."""
+        bottom, top = self.ax.get_ylim()
+        rescale = False
+        for x, band_powers in batches:
+            # log10 of a flat epoch is -inf; like NaN, it is left blank
+            band_powers = np.where(np.isfinite(band_powers), band_powers,
+                                   np.nan)
+            # Epochs skipped since the last one drawn are left blank too,
+            # so the trace stays in step with the time axis
+            skipped = np.arange(max(self.drawn, x - self.historyLength), x)
+            self.powers[:, skipped % self.historyLength] = np.nan
+            self.drawn = x + len(band_powers)
+            self.powers[:, np.arange(x, self.drawn) % self.historyLength] = \
+                band_powers.T
+            # Comparisons with the blanked NaN points are simply False
+            rescale |= ((band_powers < bottom) | (band_powers > top)).any()
+        # Blank the oldest epoch so the sweep shows a gap at the write head
+        self.powers[:, self.drawn % self.historyLength] = np.nan
+        self.waves.set_segments(self.segments)
+        # Rescale only once new points leave the axes
+        if rescale:
+            # relim() ignores collections, so fit the powers directly;
+            # they hold at least the new finite points
+            low = np.nanmin(self.powers)
+            high = np.nanmax(self.powers)
+            margin = max(0.05 * (high - low), 0.1)
+            self.ax.set_ylim(low - margin, high + margin)
+            # A full draw re-captures the background via draw_event
+            self.fig.canvas.draw()
+        self.fig.canvas.restore_region(self.bg)
+        self.ax.draw_artist(self.waves)
+        self.fig.canvas.blit(self.ax.bbox)
+        self.fig.canvas.flush_events()
 
     def run(self, function=None, params=[None], verbose=False):
         """ 3. GET DATA """
+        # Acquisition runs in a worker thread and hands band powers over a
+        # bounded queue, so a slow redraw never holds up pull_chunk.
+        # Matplotlib has to stay on the main thread, which only draws.
         # The try/except structure allows to quit the while loop by aborting the
         # script with <Ctrl-C>
         print('Press Ctrl-C in the console to break the while loop.')
-        plt.ion()
-        figure, ax = plt.subplots(figsize=(8,6))
-        font = FontProperties(family='ubuntu',
-                              weight='bold',
-                              style='oblique', size=6.5)
-        x=0
+        self.stopped.clear()
+        self.error = None
+        worker = Thread(target=self.acquireInThread, args=(verbose,),
+                        daemon=True)
+        worker.start()
         try:
-            # The following loop acquires data, computes band powers, and calculates neurofeedback metrics based on those band powers
-            while True:
-    
-                """ 3.1 ACQUIRE DATA """
-                # Obtain EEG data from the LSL stream
-                eeg_data, timestamp = self.inlet.pull_chunk(
-                    timeout=1, max_samples=int(self.shiftLength * self.fs))
-    
-                # Only keep the channel we're interested in
-                ch_data = np.array(eeg_data)[:, Parameters.INDEX_CHANNEL]
-    
-                # Update EEG buffer with the new data
-                self.eeg_buffer, self.filter_state = utils.update_buffer(
-                    self.eeg_buffer, ch_data, notch=True,
-                    filter_state=self.filter_state)
-    
-                """ 3.2 COMPUTE BAND POWERS """
-                # Get newest samples from the buffer
-                data_epoch = utils.get_last_data(self.eeg_buffer,
-                                                 self.epochLength * self.fs)
-                # Compute band powers
-                band_powers = utils.compute_band_powers(data_epoch, self.fs)
-                self.band_buffer, _ = utils.update_buffer(self.band_buffer,
-                                                     np.asarray([band_powers]))
-                self.output(band_powers, verbose)
-                handles = []
-                label, = ax.plot(x, band_powers[Band.Delta], label='Delta', 
-                                 color='red')
-                handles.append(label)
-                label, = ax.plot(x, band_powers[Band.Theta], label='Theta', 
-                                 color='orange')
-                handles.append(label)
-                label, = ax.plot(x, band_powers[Band.Alpha], label='Alpha', 
-                                 color='yellow')
-                handles.append(label)
-                label, = ax.plot(x, band_powers[Band.Beta], label='Beta', 
-                                 color='green')
-                handles.append(label)
-                label, = ax.plot(x, band_powers[Band.Gamma], label='Gamma', 
-                                 color='blue')
-                handles.append(label)
-                plt.title('Brain Waves')
-                plt.legend(handles=handles, prop=font)
-                figure.canvas.draw()
-                figure.canvas.flush_events()
-                plt.show(block=False) 
-                x += 1
+            while worker.is_alive():
+                try:
+                    batches = [self.queue.get(timeout=self.shiftLength)]
+                except Empty:
+                    self.fig.canvas.flush_events()
+                    continue
+                # Catch up on everything queued meanwhile in a single blit
+                while True:
+                    try:
+                        batches.append(self.queue.get_nowait())
+                    except Empty:
+                        break
+                self.draw(batches)
                 if function is not None:
                     function(params)
-                    
-            plt.show(block=True)
+
+            # The worker only stops on its own when acquisition failed
+            if self.error is not None:
+                raise self.error
+            raise RuntimeError('acquisition stopped')
         except KeyboardInterrupt:
             print('Closing!')
-            
+        finally:
+            self.stopped.set()
+
+    def acquireInThread(self, verbose=False):
+        """Thread target: run acquire() and keep its exception for run()."""
+        try:
+            self.acquire(verbose)
+        except Exception as error:
+            self.error = error
+
+    def acquire(self, verbose=False):
+        """Producer loop: read the stream and queue band powers to draw."""
+        x = 0  # index of the first new epoch, skipped ones included
+        # The following loop acquires data, computes band powers, and calculates neurofeedback metrics based on those band powers
+        while not self.stopped.is_set():
+
+            """ 3.1 ACQUIRE DATA """
+            # Obtain EEG data from the LSL stream
+            # Drain whatever is waiting without blocking; pull_chunk returns
+            # the oldest samples first, so keep pulling until it is empty
+            chunks = []
+            while True:
+                eeg_data, timestamp = self.inlet.pull_chunk(
+                    timeout=0.0, max_samples=self.eeg_buffer.n)
+                if not eeg_data:
+                    break
+                # Only keep the channel we're interested in, converting just
+                # that column rather than the whole chunk
+                chunks.append(np.array(
+                    [sample[self.channel] for sample in eeg_data],
+                    dtype=np.float32))
+            if not chunks:
+                time.sleep(self.shiftLength * 0.25)
+                continue
+            ch_data = np.concatenate(chunks)[:, np.newaxis]
+
+            # Filter everything so the notch filter state stays continuous
+            ch_data, self.filter_state = utils.notch_filter(
+                ch_data, self.filter_state)
+            # Every sample counts towards the epoch timing, but only the
+            # newest buffer length of a backlog is still of use
+            self.pending += len(ch_data)
+            # Update EEG buffer with the new data
+            self.eeg_buffer.push(ch_data[-self.eeg_buffer.n:])
+
+            """ 3.2 COMPUTE BAND POWERS """
+            # One new epoch for every full shift received
+            n_epochs = self.pending // self.shiftSamples
+            if n_epochs == 0:
+                continue
+            self.pending -= n_epochs * self.shiftSamples
+            # Skip stale epochs of a backlog; the plot still advances past them
+            skipped = max(0, n_epochs - self.batch)
+            x += skipped
+            n_epochs -= skipped
+            # Get newest samples from the buffer, overlapping epochs
+            # ending pending samples ago
+            span = self.eeg_buffer.last(
+                self.epochSamples + (n_epochs - 1) * self.shiftSamples
+                + self.pending)
+            data_epochs = np.lib.stride_tricks.sliding_window_view(
+                span[:len(span) - self.pending, 0],
+                self.epochSamples)[::self.shiftSamples]
+            # Compute band powers for all epochs in one call
+            band_powers = self.computeBandPowers(data_epochs)
+            for powers in band_powers:
+                # A flat epoch gives -inf, which would poison the average
+                if not np.isfinite(powers).all():
+                    continue
+                np.subtract(powers, self.ema, out=self._row)
+                self._row *= self.emaAlpha
+                self.ema += self._row
+            self.output(band_powers[-1], verbose)
+            self.enqueue((x, band_powers))
+            x += n_epochs
+
+    def enqueue(self, item):
+        """Queue item for drawing, dropping the oldest one when full."""
+        while True:
+            try:
+                self.queue.put_nowait(item)
+                return
+            except Full:
+                try:
+                    self.queue.get_nowait()
+                except Empty:
+                    pass
+
+    def computeBandPowers(self, data_epochs):
+        """Band powers [n_epochs, 5] of epochs [n_epochs, n_samples]."""
+        if _bandpowers_numba.HAVE_NUMBA:
+            # Overlapping windows are a strided view; the kernel only
+            # vectorizes over C-contiguous rows
+            return _bandpowers_numba.band_powers(
+                np.ascontiguousarray(data_epochs), *self._basis)
+        # Epochs are independent columns, band-major in the feature vector
+        return utils.compute_band_powers(data_epochs.T, self.fs,
+                                         self._bins).reshape(5, -1).T
+
     def smoothBandPowers(self):
         """smooth_band_powers."""
-        return np.mean(self.band_buffer, axis=0)
+        return self.ema
     
     def output(self, bands, verbose):
-                print('Delta: ', bands[Band.Delta], 
-                      ' Theta: ', bands[Band.Theta],
-                      ' Alpha: ', bands[Band.Alpha], 
-                      ' Beta: ', bands[Band.Beta],
-                      'Gamma:', bands[Band.Gamma])
-                # Compute the average band powers for all epochs in buffer
-                # This helps to smooth out noise
-                smooth_band_powers = self.smoothBandPowers()
-    
-                if verbose:
-                    """ 3.3 COMPUTE NEUROFEEDBACK METRICS """
-                    # These metrics could also be used to drive brain-computer interfaces
-        
-                    # Alpha Protocol:
-                    # Simple redout of alpha power, divided by delta waves in order to rule out noise
-                    alpha_metric = smooth_band_powers[Band.Alpha] / \
-                        smooth_band_powers[Band.Delta]
-                    print('Alpha Relaxation: ', alpha_metric)
-        
-                    # Beta Protocol:
-                    # Beta waves have been used as a measure of mental activity and concentration
-                    # This beta over theta ratio is commonly used as neurofeedback for ADHD
-                    beta_metric = smooth_band_powers[Band.Beta] / \
-                        smooth_band_powers[Band.Theta]
-                    print('Beta Concentration: ', beta_metric)
-        
-                    # Gamma Protocol:
-                    # Gamma waves are associated with cognitive processing, Learning and memory
-                    # Gamma waves are fast rhythms that are responsible for the brain’s neural 
-                    # connections and data transfer to the outside world.
-                    gamma_metric = smooth_band_powers[Band.Gamma] # / \
-                        #smooth_band_powers[Band.Theta]
-                    print('Gamma Perception: ', gamma_metric)
-                    
-                    # Alpha/Theta Protocol:
-                    # This is another popular neurofeedback metric for stress reduction
-                    # Higher theta over alpha is supposedly associated with reduced anxiety
-                    theta_metric = smooth_band_powers[Band.Theta] / \
-                        smooth_band_powers[Band.Alpha]
-                    print('Theta Relaxation: ', theta_metric)
-    
+        """Print the newest band powers and metrics, at most once a second."""
+        if not verbose:
+            return
+        now = time.monotonic()
+        if now - self.lastLog < self.logInterval:
+            return
+        self.lastLog = now
+        delta, theta, alpha, beta, gamma = bands
+        print(f'Delta: {delta:.2f} Theta: {theta:.2f} Alpha: {alpha:.2f}'
+              f' Beta: {beta:.2f} Gamma: {gamma:.2f}')
+        # Average of the band powers over roughly the last buffer length
+        # This helps to smooth out noise
+        smooth_band_powers = self.smoothBandPowers()
+
+        """ 3.3 COMPUTE NEUROFEEDBACK METRICS """
+        # These metrics could also be used to drive brain-computer interfaces
+
+        # Alpha Protocol:
+        # Simple redout of alpha power, divided by delta waves in order to rule out noise
+
+        # Beta Protocol:
+        # Beta waves have been used as a measure of mental activity and concentration
+        # This beta over theta ratio is commonly used as neurofeedback for ADHD
+
+        # Alpha/Theta Protocol:
+        # This is another popular neurofeedback metric for stress reduction
+        # Higher theta over alpha is supposedly associated with reduced anxiety
+        alpha_metric, beta_metric, theta_metric = \
+            smooth_band_powers[RATIO_NUMERATORS] / \
+            smooth_band_powers[RATIO_DENOMINATORS]
+
+        # Gamma Protocol:
+        # Gamma waves are associated with cognitive processing, Learning and memory
+        # Gamma waves are fast rhythms that are responsible for the brain’s neural 
+        # connections and data transfer to the outside world.
+        gamma_metric = smooth_band_powers[GAMMA] # / \
+            #smooth_band_powers[THETA]
+
+        print(f'Alpha Relaxation: {alpha_metric:.3f}'
+              f' Beta Concentration: {beta_metric:.3f}'
+              f' Gamma Perception: {gamma_metric:.3f}'
+              f' Theta Relaxation: {theta_metric:.3f}')
+
 
 if __name__ == "__main__":
     print("Activating")
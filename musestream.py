@@ -6,17 +6,7 @@ Created on Mon Dec  2 22:00:56 2019
 @author: wrichter
 """
 
-import argparse
-import sys
-import muselsl
-import muselsl.stream as stream
-from muselsl import list_muses
-import muselsl.record as record
-import muselsl.view as view
-import muselsl.helper as helper
-import muselsl.muse as muse
-import muselsl.constants as constants
-from elevate import elevate
+import os
 
 acc = False
 address = '00:55:DA:B3:BE:F7'
@@ -27,11 +17,24 @@ interface = None
 name = None
 ppg = False
 
-# must run in shell 
-elevate()
-# muses = list_muses()
-# print(muses)
-stream(address, backend, interface, name, ppg, acc, gyro, disable_eeg)
+
+def main():
+    # must run in shell 
+    # elevate() restarts the script as root, so do it before loading muselsl
+    if os.geteuid() != 0:
+        from elevate import elevate
+        elevate()
+
+    # Imported here so only the streaming code is loaded, and only when run
+    from muselsl import stream
+    # from muselsl import list_muses
+    # muses = list_muses()
+    # print(muses)
+    stream(address, backend, interface, name, ppg, acc, gyro, disable_eeg)
+
+
+if __name__ == "__main__":
+    main()
 
 # to run: python /home/wrichter/Documents/Code/Projects/Python/neural/musestream.py
 # To View: muselsl view --version 2
@@ -10,16 +10,31 @@ epoching, and transforming EEG data into frequency bands
 
 import os
 import sys
+from functools import lru_cache
 from tempfile import gettempdir
 from subprocess import call
 
 import matplotlib.pyplot as plt
 import numpy as np
+import scipy.fft as sfft
 from sklearn import svm
-from scipy.signal import butter, lfilter, lfilter_zi
+from scipy.signal import butter, sosfilt, sosfilt_zi
 
+try:
+    import pyfftw
+except ImportError:
+    pyfftw = None
 
-NOTCH_B, NOTCH_A = butter(4, np.array([55, 65]) / (256 / 2), btype='bandstop')
+
+# Factored once into second-order sections; EEG needs no more than float32
+NOTCH_SOS = butter(4, np.array([55, 65]) / (256 / 2), btype='bandstop',
+                   output='sos').astype(np.float32)
+
+# FFTW plans measured in earlier sessions are reused from here; kept in the
+# user's own cache dir rather than the shared temp dir
+FFTW_WISDOM = os.path.join(
+    os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'),
+    'neural', 'fftw_wisdom')
 
 
 def epoch(data, samples_epoch, samples_overlap=0):
@@ -60,13 +75,15 @@ def epoch(data, samples_epoch, samples_overlap=0):
     return epochs
 
 
-def compute_band_powers(eegdata, fs):
+def compute_band_powers(eegdata, fs, bins=None):
     """Extract the features (band powers) from the EEG.
 
     Args:
         eegdata (numpy.ndarray): array of dimension [number of samples,
                 number of channels]
         fs (float): sampling frequency of eegdata
+        bins (tuple): output of get_band_bins for this epoch length, for
+                callers that precompute it; looked up when None
 
     Returns:
         (numpy.ndarray): feature matrix of shape [number of feature points,
@@ -75,42 +92,120 @@ def compute_band_powers(eegdata, fs):
     # 1. Compute the PSD
     winSampleLength, nbCh = eegdata.shape
 
-    # Apply Hamming window
-    w = np.hamming(winSampleLength)
+    # Apply Hamming window, in the precision of the data
+    w = hamming(winSampleLength, eegdata.dtype)
     dataWinCentered = eegdata - np.mean(eegdata, axis=0)  # Remove offset
     dataWinCenteredHam = (dataWinCentered.T * w).T
 
+    # The input is real, so only the positive half of the spectrum is needed
     NFFT = nextpow2(winSampleLength)
-    Y = np.fft.fft(dataWinCenteredHam, n=NFFT, axis=0) / winSampleLength
-    PSD = 2 * np.abs(Y[0:int(NFFT / 2), :])
-    f = fs / 2 * np.linspace(0, 1, int(NFFT / 2))
+    if pyfftw is not None:
+        fft = fftw_plan(NFFT, nbCh, dataWinCenteredHam.dtype)
+        fft.input_array[:winSampleLength] = dataWinCenteredHam
+        fft.input_array[winSampleLength:] = 0
+        Y = fft()
+    else:
+        Y = sfft.rfft(dataWinCenteredHam, n=NFFT, axis=0, overwrite_x=True)
 
     # SPECTRAL FEATURES
-    # Average of band powers
-    # Delta <4
-    ind_delta, = np.where(f < 4)
-    meanDelta = np.mean(PSD[ind_delta, :], axis=0)
-    # Theta 4-8
-    ind_theta, = np.where((f >= 4) & (f <= 8))
-    meanTheta = np.mean(PSD[ind_theta, :], axis=0)
-    # Alpha 8-12
-    ind_alpha, = np.where((f >= 8) & (f <= 12))
-    meanAlpha = np.mean(PSD[ind_alpha, :], axis=0)
-    # Beta 12-30
-    ind_beta, = np.where((f >= 12) & (f < 30))
-    meanBeta = np.mean(PSD[ind_beta, :], axis=0)
-    # Gamma 31-100
-    ind_gamma, = np.where((f >= 31) & (f < 100))
-    meanGamma = np.mean(PSD[ind_gamma, :], axis=0)
-    
-    feature_vector = np.concatenate((meanDelta, meanTheta, meanAlpha,
-                                     meanBeta, meanGamma), axis=0)
-
-    feature_vector = np.log10(feature_vector)
+    # Average of band powers, all five bands summed in a single pass
+    if bins is None:
+        bins = get_band_bins(NFFT, fs)
+    edges, invWidths = bins
+    PSD = np.abs(Y[:edges[-1], :])
+    bandSums = np.add.reduceat(PSD, edges[:-1], axis=0)[::2]
+    # Average over each band and scale to the one-sided amplitude spectrum,
+    # in place so the band sums are the only array the log touches
+    bandSums *= invWidths[:, None]
+    bandSums *= 2 / winSampleLength
+
+    feature_vector = bandSums.ravel()
+    np.log10(feature_vector, out=feature_vector)
 
     return feature_vector
 
 
+@lru_cache()
+def hamming(n, dtype=np.float64):
+    """
+    Hamming window of length n, cached between epochs
+    """
+    return np.hamming(n).astype(dtype)
+
+
+@lru_cache()
+def fftw_plan(nfft, nbCh, dtype):
+    """Build a real FFT plan along axis 0 with pyFFTW.
+
+    The plan owns aligned input and output arrays that are reused on every
+    call, and its wisdom is saved to FFTW_WISDOM so FFTW_MEASURE only has
+    to time the candidate codelets once per shape.
+
+    Args:
+        nfft (int): FFT length
+        nbCh (int): number of channels (columns) transformed at once
+        dtype (numpy.dtype): float32 or float64 input type
+
+    Returns:
+        (pyfftw.FFTW): plan with input [nfft, nbCh] and output
+            [nfft / 2 + 1, nbCh]
+    """
+    # Wisdom is only a planning hint, so an unreadable file is ignored
+    try:
+        with open(FFTW_WISDOM, 'rb') as f:
+            wisdom = tuple(f.read().split(b'\0'))
+        # One plain-text entry each for double, single and long double
+        if len(wisdom) != 3:
+            raise ValueError('malformed FFTW wisdom')
+        pyfftw.import_wisdom(wisdom)
+    except (OSError, ValueError):
+        pass
+
+    dtype = np.dtype(dtype)
+    complexType = np.result_type(dtype, np.complex64)
+    a = pyfftw.empty_aligned((nfft, nbCh), dtype=dtype)
+    b = pyfftw.empty_aligned((nfft // 2 + 1, nbCh), dtype=complexType)
+    plan = pyfftw.FFTW(a, b, axes=(0,),
+                       flags=('FFTW_MEASURE', 'FFTW_DESTROY_INPUT'))
+
+    try:
+        os.makedirs(os.path.dirname(FFTW_WISDOM), exist_ok=True)
+        with open(FFTW_WISDOM, 'wb') as f:
+            f.write(b'\0'.join(pyfftw.export_wisdom()))
+    except OSError:
+        pass
+
+    return plan
+
+
+@lru_cache()
+def get_band_bins(nfft, fs):
+    """Find the PSD bins of each frequency band.
+
+    Args:
+        nfft (int): FFT length
+        fs (float): sampling frequency
+
+    Returns:
+        (numpy.ndarray): [start, stop] bin pairs for delta, theta, alpha,
+            beta and gamma, flattened for use with np.add.reduceat
+        (numpy.ndarray): inverse of the number of bins in each band
+    """
+    f = fs / 2 * np.linspace(0, 1, int(nfft / 2))
+    masks = (f < 4,                   # Delta <4
+             (f >= 4) & (f <= 8),     # Theta 4-8
+             (f >= 8) & (f <= 12),    # Alpha 8-12
+             (f >= 12) & (f < 30),    # Beta 12-30
+             (f >= 31) & (f < 100))   # Gamma 31-100
+    edges = []
+    for mask in masks:
+        ind, = np.where(mask)
+        edges += [ind[0], ind[-1] + 1]
+    edges = np.array(edges)
+
+    return edges, 1 / (edges[1::2] - edges[::2])
+
+
 def nextpow2(i):
     """
     Find the next power of 2 for number i
@@ -158,6 +253,20 @@ def get_feature_names(ch_names):
     return feat_names
 
 
+def notch_filter(new_data, filter_state=None, sos=NOTCH_SOS):
+    """
+    Applies the 55-65 Hz bandstop filter (or the second-order sections
+    "sos") to "new_data" [n_samples, n_channels], carrying "filter_state"
+    over from the previous call
+    """
+    if filter_state is None:
+        zi = sosfilt_zi(sos).astype(np.float32)
+        filter_state = np.repeat(zi[:, :, np.newaxis], new_data.shape[1],
+                                 axis=2)
+    return sosfilt(sos, new_data.astype(np.float32, copy=False), axis=0,
+                   zi=filter_state)
+
+
 def update_buffer(data_buffer, new_data, notch=False, filter_state=None):
     """
     Concatenates "new_data" into "data_buffer", and returns an array with
@@ -167,11 +276,7 @@ def update_buffer(data_buffer, new_data, notch=False, filter_state=None):
         new_data = new_data.reshape(-1, data_buffer.shape[1])
 
     if notch:
-        if filter_state is None:
-            filter_state = np.tile(lfilter_zi(NOTCH_B, NOTCH_A),
-                                   (data_buffer.shape[1], 1)).T
-        new_data, filter_state = lfilter(NOTCH_B, NOTCH_A, new_data, axis=0,
-                                         zi=filter_state)
+        new_data, filter_state = notch_filter(new_data, filter_state)
 
     new_buffer = np.concatenate((data_buffer, new_data), axis=0)
     new_buffer = new_buffer[new_data.shape[0]:, :]
@@ -187,3 +292,49 @@ def get_last_data(data_buffer, newest_samples):
     new_buffer = data_buffer[(data_buffer.shape[0] - newest_samples):, :]
 
     return new_buffer
+
+
+class RingBuffer:
+    """Fixed-size circular buffer of [n_samples, n_channels] rows.
+
+    New rows overwrite the oldest ones in place, so pushing never
+    reallocates or shifts the whole buffer like update_buffer does.
+
+    Args:
+        n (int): number of rows (samples) held
+        ch (int): number of columns (channels)
+        dtype (numpy.dtype): element type of the buffer
+    """
+
+    def __init__(self, n, ch, dtype=float):
+        self.data = np.zeros((n, ch), dtype=dtype)
+        self.head = 0  # index of the next row to be written
+        self.n = n
+
+    def push(self, new_data):
+        """
+        Writes "new_data" [n_samples, n_channels] after the newest row,
+        wrapping around the end of the buffer
+        """
+        k = new_data.shape[0]
+        if k >= self.n:
+            self.data[:] = new_data[k - self.n:]
+            self.head = 0
+            return
+        first = min(k, self.n - self.head)
+        self.data[self.head:self.head + first] = new_data[:first]
+        self.data[:k - first] = new_data[first:]
+        self.head = (self.head + k) % self.n
+
+    def last(self, newest_samples):
+        """
+        Obtains the "newest samples" rows in chronological order; a view
+        into the buffer unless they wrap around its end
+        """
+        if newest_samples > self.n:
+            raise ValueError('Requested %d samples from a buffer of %d'
+                             % (newest_samples, self.n))
+        start = self.head - newest_samples
+        if start >= 0:
+            return self.data[start:self.head]
+        return np.concatenate((self.data[start:], self.data[:self.head]))